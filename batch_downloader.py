@@ -0,0 +1,277 @@
+"""
+Batch downloads for messages that contain several links or a playlist.
+Items flow through a pipeline so that metadata, download and upload of
+different items overlap, while results are still delivered in order.
+"""
+
+import os
+import re
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, Awaitable, Callable, List, NamedTuple, Optional, Sequence, Tuple, Type
+import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "10"))  # Hard cap per message
+PLAYLIST_LIMIT = int(os.getenv("PLAYLIST_LIMIT", "10"))  # 0 disables playlist expansion
+MAX_IN_FLIGHT = 4  # Items downloaded ahead of the one being delivered
+STATUS_INTERVAL = 1.0  # Seconds between status message edits (Telegram flood limits)
+FINAL_STATUS_ATTEMPTS = 3
+
+URL_PATTERN = re.compile(r"https?://[^\s<>\"']+")
+
+
+@dataclass
+class BatchItem:
+    """A single link inside a batch and its progress through the pipeline."""
+
+    index: int
+    url: str
+    platform: Optional[str]
+    title: str = ""
+    file_path: Optional[str] = None
+    status: str = "queued"
+    error: Optional[str] = None
+    job: Any = None  # Set by callers that track items individually (see `item_context`)
+
+
+class Stage(NamedTuple):
+    """A pipeline step: `func` fills in fields of the item it is given."""
+
+    name: str
+    func: Callable[[BatchItem], Awaitable[None]]
+    concurrency: int
+
+
+def extract_urls(text: str) -> List[str]:
+    """
+    Find every link in a message.
+
+    Args:
+        text: Message text
+
+    Returns:
+        Unique URLs in the order they appear
+    """
+    urls = []
+    for match in URL_PATTERN.findall(text or ""):
+        url = match.rstrip(".,;:!?)]}")
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+
+def is_playlist_url(url: str) -> bool:
+    """Check whether a link points to a YouTube playlist rather than a single video."""
+    return PLAYLIST_LIMIT > 0 and "youtube.com/playlist" in url and "list=" in url
+
+
+async def expand_playlist(url: str, limit: int = PLAYLIST_LIMIT) -> List[str]:
+    """
+    Resolve a playlist link to the URLs of its first `limit` videos.
+    Uses flat extraction, so no per-video metadata is fetched here.
+    """
+
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 30,
+        'nocheckcertificate': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': limit,
+    }
+
+    def _do_expand() -> List[str]:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            urls = []
+            for entry in (info.get('entries') or [])[:limit]:
+                if not entry:
+                    continue
+                entry_url = entry.get('url') or entry.get('webpage_url')
+                if not entry_url and entry.get('id'):
+                    entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+                if entry_url:
+                    urls.append(entry_url)
+            return urls
+
+    return await asyncio.to_thread(_do_expand)
+
+
+@asynccontextmanager
+async def _no_context(item: BatchItem):
+    yield item
+
+
+def render_status(items: Sequence[BatchItem]) -> str:
+    """Build the single aggregated status message for a batch."""
+    icons = {
+        "queued": "⏳",
+        "done": "✅",
+        "failed": "❌",
+        "interrupted": "⏸",
+    }
+    finished = sum(1 for item in items if item.status in ("done", "failed"))
+    lines = [f"📦 Batch: {finished}/{len(items)} finished"]
+    for item in items:
+        icon = icons.get(item.status, "🔄")
+        label = item.title or item.url
+        if len(label) > 50:
+            label = label[:47] + "..."
+        line = f"{icon} {item.index + 1}. {label}"
+        if item.status not in icons:
+            line += f" ({item.status})"
+        if item.error:
+            line += f" — {item.error[:80]}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class BatchPipeline:
+    """
+    Runs batch items through a sequence of stages with per-stage concurrency.
+
+    Each stage has its own semaphore, so while one item is uploading the next
+    can be downloading and a third fetching metadata. Delivery is the final,
+    strictly ordered step: item N is delivered only after item N-1.
+    """
+
+    def __init__(self, stages: Sequence[Stage],
+                 deliver: Callable[[BatchItem], Awaitable[None]],
+                 on_progress: Optional[Callable[[Sequence[BatchItem]], Awaitable[None]]] = None,
+                 max_in_flight: int = MAX_IN_FLIGHT,
+                 item_context: Callable[[BatchItem], AsyncContextManager] = _no_context,
+                 interrupted_errors: Tuple[Type[Exception], ...] = ()):
+        """
+        Args:
+            stages: Steps every item goes through before delivery
+            deliver: Sends a finished item to the user (called in order)
+            on_progress: Called with all items after status changes, at most
+                once per STATUS_INTERVAL and once more when the run ends
+            max_in_flight: How many items may be past the queue at once,
+                which bounds the files waiting on disk for delivery
+            item_context: Wraps each item's processing (in the item's own task);
+                an exception raised on entry marks the item as failed
+            interrupted_errors: Exceptions meaning the item was handed over
+                rather than failed (e.g. on shutdown); such items, like
+                cancelled ones, are reported as "interrupted"
+        """
+        self.stages = stages
+        self.deliver = deliver
+        self.on_progress = on_progress
+        self.max_in_flight = max_in_flight
+        self.item_context = item_context
+        self.interrupted_errors = interrupted_errors
+        self.items: List[BatchItem] = []
+        self._changed = asyncio.Event()
+
+    async def _set_status(self, item: BatchItem, status: str) -> None:
+        # Only flags the change; `_report` sends it, off the items' critical path
+        item.status = status
+        self._changed.set()
+
+    async def _report(self) -> None:
+        """Send status changes to `on_progress`, at most once per STATUS_INTERVAL."""
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                await self.on_progress(self.items)
+            except Exception as e:
+                logger.warning(f"Progress callback failed: {e}")
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    async def _report_final(self) -> None:
+        """Send the final status, retrying if the edit is rate limited."""
+        for attempt in range(FINAL_STATUS_ATTEMPTS):
+            try:
+                await self.on_progress(self.items)
+                return
+            except Exception as e:
+                logger.warning(f"Final progress callback failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(getattr(e, "retry_after", None) or STATUS_INTERVAL)
+
+    async def _run_item(self, item: BatchItem, semaphores: List[asyncio.Semaphore],
+                        previous: Optional[asyncio.Event]) -> None:
+        if item.error is None:
+            for stage, semaphore in zip(self.stages, semaphores):
+                async with semaphore:
+                    await self._set_status(item, stage.name)
+                    await stage.func(item)
+
+        if previous is not None:
+            await previous.wait()
+
+        if item.error is None:
+            await self._set_status(item, "uploading")
+            await self.deliver(item)
+            await self._set_status(item, "done")
+        else:
+            await self._set_status(item, "failed")
+
+    async def _process(self, item: BatchItem, semaphores: List[asyncio.Semaphore],
+                       in_flight: asyncio.Semaphore, previous: Optional[asyncio.Event],
+                       delivered: asyncio.Event) -> None:
+        async with in_flight:
+            try:
+                async with self.item_context(item):
+                    await self._run_item(item, semaphores, previous)
+            except asyncio.CancelledError:
+                # Cancelled on shutdown by whoever handed the item over
+                await self._set_status(item, "interrupted")
+                raise
+            except Exception as e:
+                if isinstance(e, self.interrupted_errors):
+                    logger.info(f"Batch item {item.index} ({item.url}) interrupted: {e}")
+                    await self._set_status(item, "interrupted")
+                else:
+                    logger.error(f"Batch item {item.index} ({item.url}) failed: {e}")
+                    item.error = str(e)
+                    await self._set_status(item, "failed")
+                # A stage may fail before the earlier items are delivered;
+                # releasing the next item now would let it overtake them
+                if previous is not None:
+                    await previous.wait()
+            finally:
+                delivered.set()
+                # Interrupted items (cancelled mid-stage) are left to `item_context`
+                finished = item.status in ("done", "failed")
+                if finished and item.file_path and os.path.exists(item.file_path):
+                    os.remove(item.file_path)
+                    logger.info(f"Deleted file: {item.file_path}")
+
+    async def run(self, items: Sequence[BatchItem]) -> List[BatchItem]:
+        """
+        Process all items and return them with their final status.
+        Items whose `error` is already set are reported as failed without running.
+        Cancelled items do not stop the others, and the final status is still sent.
+        """
+        self.items = list(items)
+        semaphores = [asyncio.Semaphore(max(1, stage.concurrency)) for stage in self.stages]
+        in_flight = asyncio.Semaphore(max(1, self.max_in_flight))
+
+        tasks = []
+        previous = None
+        for item in self.items:
+            delivered = asyncio.Event()
+            tasks.append(asyncio.create_task(
+                self._process(item, semaphores, in_flight, previous, delivered)
+            ))
+            previous = delivered
+
+        if self.on_progress is None:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return self.items
+
+        self._changed.set()
+        reporter = asyncio.create_task(self._report())
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+        await self._report_final()
+        return self.items
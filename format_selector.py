@@ -0,0 +1,229 @@
+"""
+Format selection shared by the downloaders.
+Ranks the formats yt-dlp offers by the processing they cause (ffmpeg merges,
+non-streamable codecs, fragmented downloads, files over Telegram's limit)
+and picks the cheapest one, preferring progressive H.264/AAC MP4 files.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MAX_BYTES = 50 * 1024 * 1024  # Bot API upload limit
+
+# Costs are in arbitrary points; the candidate with the lowest total wins.
+# QUALITY_WEIGHT is subtracted in proportion to the height reached, so when a
+# resolution was requested a merge wins if it buys at least one resolution step
+# over a progressive file. Without a requested resolution, merges are only
+# considered when no progressive file is known to fit (see FormatSelector).
+QUALITY_WEIGHT = 60
+MERGE_COST = 12
+OVERSIZE_COST = 1000
+# yt-dlp already estimates sizes from bitrate and duration, so an unknown size
+# means neither is known and the upload may fail outright. That risk outweighs
+# a resolution step or two (720p to 1080p is worth 20 points).
+UNKNOWN_SIZE_COST = 40
+NON_MP4_COST = 20  # Telegram only streams MP4 inline
+VIDEO_CODEC_COST = {"h264": 0, "hevc": 15, "vp9": 30, "av1": 40, "unknown": 5}
+AUDIO_CODEC_COST = {"aac": 0, "mp3": 2, "opus": 10, "vorbis": 10, "unknown": 3}
+PROTOCOL_COST = {"https": 0, "http": 0, "http_dash_segments": 5, "m3u8": 10, "m3u8_native": 10}
+
+MERGE_OUTPUT_FORMAT = "mp4"
+# Merges re-run ffmpeg anyway, so moving the moov atom to the front is free
+MERGER_ARGS = {"merger": ["-movflags", "+faststart"]}
+
+CODEC_FAMILIES = {
+    "avc": "h264", "h264": "h264",
+    "hev": "hevc", "hvc": "hevc", "h265": "hevc",
+    "vp9": "vp9", "vp09": "vp9",
+    "av01": "av1",
+    "mp4a": "aac", "aac": "aac",
+    "mp3": "mp3", "opus": "opus", "vorbis": "vorbis",
+}
+
+
+def codec_family(codec: Optional[str]) -> Optional[str]:
+    """Normalize a yt-dlp codec string ('avc1.64001F', 'opus', 'none', None)."""
+    if codec == "none":
+        return None
+    if not codec:
+        return "unknown"
+    codec = codec.lower()
+    for prefix, family in CODEC_FAMILIES.items():
+        if codec.startswith(prefix):
+            return family
+    return "unknown"
+
+
+def estimate_size(fmt: dict) -> Optional[int]:
+    """
+    Best guess of a format's size in bytes, or None if nothing is known.
+    yt-dlp fills `filesize_approx` from bitrate and duration when it can.
+    """
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    return int(size) if size else None
+
+
+@dataclass
+class FormatChoice:
+    """The format picked for a download and why."""
+
+    format_id: str
+    ext: str
+    height: Optional[int]
+    vcodec: Optional[str]
+    acodec: Optional[str]
+    size: Optional[int]
+    needs_merge: bool
+    cost: float
+
+    def describe(self) -> str:
+        parts = [f"{self.height}p" if self.height else "unknown height",
+                 f"{self.vcodec}+{self.acodec}", self.ext,
+                 "merge" if self.needs_merge else "no merge"]
+        if self.size:
+            parts.append(f"~{self.size / 1024 / 1024:.1f} MB")
+        return f"{self.format_id} ({', '.join(parts)})"
+
+
+class FormatSelector:
+    """
+    Callable for yt-dlp's `format` option.
+
+    Scores every progressive format and every video+audio pair, yields the
+    cheapest one to yt-dlp and keeps it in `choice` for reporting. Without
+    `max_height` (social and Instagram links) any progressive file known to
+    fit the size limit beats a merge, as yt-dlp's plain 'best' never merged.
+    """
+
+    def __init__(self, max_height: Optional[int] = None, size_limit: int = TELEGRAM_MAX_BYTES):
+        """
+        Args:
+            max_height: Highest resolution to consider (None for no cap)
+            size_limit: Files estimated above this are only used if nothing fits
+        """
+        self.max_height = max_height
+        self.size_limit = size_limit
+        self.choice: Optional[FormatChoice] = None
+
+    def _base_cost(self, fmt: dict, cap: int) -> float:
+        height = fmt.get("height") or 0
+        cost = PROTOCOL_COST.get(fmt.get("protocol") or "https", 5)
+        cost -= QUALITY_WEIGHT * min(height, cap) / cap if cap else 0
+        return cost
+
+    def _size_cost(self, size: Optional[int]) -> float:
+        if size is None:
+            return UNKNOWN_SIZE_COST
+        return OVERSIZE_COST if size > self.size_limit else 0
+
+    def _score_progressive(self, fmt: dict, cap: int) -> Tuple[float, Optional[int]]:
+        size = estimate_size(fmt)
+        cost = self._base_cost(fmt, cap) + self._size_cost(size)
+        cost += VIDEO_CODEC_COST.get(codec_family(fmt.get("vcodec")), 5)
+        cost += AUDIO_CODEC_COST.get(codec_family(fmt.get("acodec")), 3)
+        cost += 0 if fmt.get("ext") == "mp4" else NON_MP4_COST
+        return cost, size
+
+    def _best_audio(self, audio_formats: List[dict]) -> Optional[dict]:
+        def audio_cost(fmt: dict) -> Tuple[float, float]:
+            cost = AUDIO_CODEC_COST.get(codec_family(fmt.get("acodec")), 3)
+            cost += PROTOCOL_COST.get(fmt.get("protocol") or "https", 5)
+            return cost, -(fmt.get("abr") or fmt.get("tbr") or 0)
+        return min(audio_formats, key=audio_cost, default=None)
+
+    def _score_merge(self, video: dict, audio: dict, cap: int) -> Tuple[float, Optional[int]]:
+        video_size = estimate_size(video)
+        audio_size = estimate_size(audio)
+        size = video_size + audio_size if video_size and audio_size else None
+        cost = self._base_cost(video, cap) + self._size_cost(size) + MERGE_COST
+        cost += VIDEO_CODEC_COST.get(codec_family(video.get("vcodec")), 5)
+        cost += AUDIO_CODEC_COST.get(codec_family(audio.get("acodec")), 3)
+        cost += PROTOCOL_COST.get(audio.get("protocol") or "https", 5)
+        # The merger writes MP4, but only MP4-family streams go in without re-encoding
+        if video.get("ext") != "mp4":
+            cost += NON_MP4_COST
+        return cost, size
+
+    @staticmethod
+    def _merged(video: dict, audio: dict) -> dict:
+        return {
+            "format_id": f"{video['format_id']}+{audio['format_id']}",
+            "format": f"{video.get('format')}+{audio.get('format')}",
+            "ext": MERGE_OUTPUT_FORMAT,
+            "requested_formats": [video, audio],
+            "protocol": f"{video.get('protocol')}+{audio.get('protocol')}",
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "fps": video.get("fps"),
+            "vcodec": video.get("vcodec"),
+            "acodec": audio.get("acodec"),
+            "tbr": (video.get("tbr") or 0) + (audio.get("tbr") or 0) or None,
+        }
+
+    def __call__(self, ctx: dict) -> Iterator[dict]:
+        formats = ctx.get("formats") or []
+
+        video = [f for f in formats if codec_family(f.get("vcodec")) is not None]
+        if self.max_height:
+            capped = [f for f in video if (f.get("height") or 0) <= self.max_height]
+            video = capped or video
+        audio_only = [f for f in formats
+                      if codec_family(f.get("vcodec")) is None and codec_family(f.get("acodec")) is not None]
+
+        if not video:
+            # Nothing to rank (e.g. an audio-only post); let yt-dlp's best pick stand
+            if formats:
+                yield formats[-1]
+            return
+
+        cap = self.max_height or max((f.get("height") or 0) for f in video)
+        best_audio = self._best_audio(audio_only)
+
+        candidates = []
+        for fmt in video:
+            if codec_family(fmt.get("acodec")) is not None:
+                cost, size = self._score_progressive(fmt, cap)
+                candidates.append((cost, size, fmt, None))
+            elif best_audio is not None:
+                cost, size = self._score_merge(fmt, best_audio, cap)
+                candidates.append((cost, size, fmt, best_audio))
+
+        if not candidates:
+            yield formats[-1]
+            return
+
+        if not self.max_height:
+            progressive = [c for c in candidates
+                           if c[3] is None and c[1] is not None and c[1] <= self.size_limit]
+            candidates = progressive or candidates
+
+        # Later formats are better according to the extractor, so they win ties
+        cost, size, fmt, audio = min(reversed(candidates), key=lambda c: c[0])
+        chosen = self._merged(fmt, audio) if audio else fmt
+        self.choice = FormatChoice(
+            format_id=chosen["format_id"],
+            ext=chosen.get("ext") or "",
+            height=chosen.get("height"),
+            vcodec=codec_family(chosen.get("vcodec")),
+            acodec=codec_family(chosen.get("acodec")),
+            size=size,
+            needs_merge=audio is not None,
+            cost=cost,
+        )
+        logger.debug(f"Selected format {self.choice.describe()} from {len(candidates)} candidate(s)")
+        yield chosen
+
+
+def format_options(max_height: Optional[int] = None) -> dict:
+    """
+    yt-dlp options for cost-aware video format selection. The selector under
+    'format' keeps the final choice, which staging.download_staged reports.
+    """
+    return {
+        'format': FormatSelector(max_height=max_height),
+        'merge_output_format': MERGE_OUTPUT_FORMAT,
+        'postprocessor_args': MERGER_ARGS,
+    }
@@ -2,17 +2,22 @@ import os
 import yt_dlp
 import asyncio
 import logging
+from typing import Optional
+import format_selector
+import staging
 
 logger = logging.getLogger(__name__)
 
 DOWNLOAD_DIR = "downloads"
 
-async def download_instagram_video(url: str, user_id: int) -> str:
+async def download_instagram_video(url: str, user_id: int, info: Optional[dict] = None) -> staging.StagedDownload:
     """Download Instagram video"""
     
+    format_opts = format_selector.format_options()
+    
     ydl_opts = {
-        'format': 'best',
-        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{user_id}_%(title)s.%(ext)s'),
+        **format_opts,
+        'outtmpl': f'{user_id}_%(title)s [%(id)s].%(ext)s',
         'quiet': False,
         'no_warnings': True,
         'socket_timeout': 30,
@@ -20,14 +25,9 @@ async def download_instagram_video(url: str, user_id: int) -> str:
         'no_color': True,
     }
 
-    def _do_download() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            return ydl.prepare_filename(info)
-
-    return await asyncio.to_thread(_do_download)
+    return await asyncio.to_thread(staging.download_staged, ydl_opts, url, info)
 
-async def download_instagram_audio(url: str, user_id: int) -> str:
+async def download_instagram_audio(url: str, user_id: int, info: Optional[dict] = None) -> staging.StagedDownload:
     """Download Instagram video as MP3"""
     
     ydl_opts = {
@@ -37,7 +37,7 @@ async def download_instagram_audio(url: str, user_id: int) -> str:
             'preferredcodec': 'mp3',
             'preferredquality': '192',
         }],
-        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{user_id}_%(title)s.%(ext)s'),
+        'outtmpl': f'{user_id}_%(title)s [%(id)s].%(ext)s',
         'quiet': False,
         'no_warnings': True,
         'socket_timeout': 30,
@@ -45,16 +45,14 @@ async def download_instagram_audio(url: str, user_id: int) -> str:
         'no_color': True,
     }
 
-    def _do_download_mp3() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            file_path_local = ydl.prepare_filename(info)
-            return os.path.splitext(file_path_local)[0] + '.mp3'
+    def _do_download_mp3() -> staging.StagedDownload:
+        download = staging.download_staged(ydl_opts, url, info)
+        return download._replace(path=os.path.splitext(download.path)[0] + '.mp3')
 
     return await asyncio.to_thread(_do_download_mp3)
 
-async def get_instagram_title(url: str) -> str:
-    """Get Instagram video title/caption"""
+async def get_instagram_title(url: str, info: Optional[dict] = None) -> str:
+    """Get Instagram video title/caption (from `info` if already fetched)"""
     
     ydl_opts = {
         'quiet': True,
@@ -64,9 +62,11 @@ async def get_instagram_title(url: str) -> str:
     }
 
     def _do_get_title() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            t = info.get('title', 'Instagram Video')
-            return t if len(t) <= 100 else t[:97] + "..."
+        data = info
+        if data is None:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                data = ydl.extract_info(url, download=False)
+        t = data.get('title') or 'Instagram Video'
+        return t if len(t) <= 100 else t[:97] + "..."
 
     return await asyncio.to_thread(_do_get_title)
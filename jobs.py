@@ -0,0 +1,321 @@
+"""
+In-flight job tracking for graceful shutdown.
+Keeps a registry of running download jobs so that shutdown can wait for them,
+hand unfinished ones over to the next process, and clean up partial files.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from yt_dlp.utils import DownloadCancelled
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_DIR = "downloads"
+JOURNAL_FILE = "pending_jobs.json"
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "60"))  # Seconds to let running jobs finish
+THREAD_EXIT_TIMEOUT = 10  # Minimum wait for aborted worker threads after the hand-off
+JOURNAL_MAX_AGE = 6 * 3600  # Older handed-off jobs are dropped instead of resumed
+STALE_FILE_AGE = 600  # Startup sweep leaves files touched more recently than this alone
+
+# Stages after which the downloaded file is complete and worth handing over
+HANDOFF_STAGES = ("downloaded", "uploading")
+
+FORMAT_SUFFIX = re.compile(r"\.f[\w-]+$")
+RUNTIME_FIELDS = ("files", "aborted", "info")
+
+
+@dataclass
+class Job:
+    """A single download requested by a user, in a form that can be saved and resumed."""
+
+    chat_id: int
+    user_id: int
+    url: str
+    platform: str
+    quality: Optional[str] = None
+    title: Optional[str] = None
+    height: Optional[int] = None  # Resolution actually downloaded, when known
+    file_path: Optional[str] = None
+    status_message_id: Optional[int] = None
+    stage: str = "queued"
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    created_at: float = field(default_factory=time.time)
+    # Runtime state, not saved to the journal
+    files: Set[str] = field(default_factory=set, repr=False)  # Files yt-dlp reported writing
+    aborted: bool = field(default=False, repr=False)  # Set on shutdown to stop the download
+    info: Optional[dict] = field(default=None, repr=False)  # Metadata already fetched, reused by the download
+
+    def to_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.name not in RUNTIME_FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Job":
+        known = set(cls.__dataclass_fields__) - set(RUNTIME_FIELDS)
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+
+class JobDeferred(Exception):
+    """Raised when a job arrives after shutdown started; it is saved for the next process."""
+
+
+current_job: ContextVar[Optional[Job]] = ContextVar("current_job", default=None)
+
+
+def progress_hook(d: dict) -> None:
+    """
+    yt-dlp progress hook used by every downloader: records the files the
+    current job writes and stops the download once the job was aborted.
+
+    asyncio.to_thread copies context variables, so the job that started the
+    download is visible here even though the hook runs in a worker thread.
+    """
+    job = current_job.get()
+    if job is None:
+        return
+    for key in ("filename", "tmpfilename"):
+        if d.get(key):
+            job.files.add(d[key])
+    if job.aborted:
+        raise DownloadCancelled("Shutting down")
+
+
+def remove_download_files(paths: Iterable[str]) -> None:
+    """Delete downloaded files along with yt-dlp's partial and intermediate files for them."""
+    candidates = set()
+    for path in paths:
+        if path.endswith(".part"):
+            path = path[:-5]
+        stem, ext = os.path.splitext(path)
+        candidates.update({path, path + ".part", path + ".ytdl"})
+        if FORMAT_SUFFIX.search(stem):
+            # <name>.f137.mp4 is merged into <name>.temp.mp4, then renamed to <name>.mp4
+            merged_stem = FORMAT_SUFFIX.sub("", stem)
+            candidates.update({merged_stem + ".temp" + ext, merged_stem + ext})
+        candidates.update(glob.glob(glob.escape(path) + ".part-Frag*"))
+
+    for path in candidates:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+                logger.info(f"Deleted file: {path}")
+        except OSError as e:
+            logger.warning(f"Could not delete {path}: {e}")
+
+
+class JobRegistry:
+    """Tracks running jobs and coordinates draining, handoff and cleanup on shutdown."""
+
+    def __init__(self, journal_file: str = JOURNAL_FILE, download_dir: str = DOWNLOAD_DIR):
+        """Initialize an empty registry that writes its journal to `journal_file`."""
+        self.journal_file = journal_file
+        self.download_dir = download_dir
+        self.accepting = True
+        self._active: Dict[str, Tuple[Job, asyncio.Task]] = {}
+        self._queued: Dict[str, Job] = {}
+        self._deferred: List[Job] = []
+        self._journaled: Optional[List[Job]] = None
+        self._handed_off: Set[str] = set()
+        self._interrupted: List[Job] = []
+
+    def queue(self, job: Job) -> None:
+        """
+        Register a job that will start later (e.g. a batch item waiting for its
+        turn), so it is handed off if shutdown comes before it starts.
+        """
+        self._queued[job.id] = job
+
+    def unqueue(self, job: Job) -> None:
+        """Forget a queued job that will not start after all (e.g. its chat is gone)."""
+        self._queued.pop(job.id, None)
+
+    def _defer(self, job: Job) -> None:
+        if self._journaled is None:
+            self._deferred.append(job)
+        elif all(saved.id != job.id for saved in self._journaled):
+            # Arrived after the journal was written: add it there directly
+            self._journaled.append(self._resumable(job))
+            self.save_journal(self._journaled)
+
+    @asynccontextmanager
+    async def track(self, job: Job):
+        """
+        Register `job` as running in the current task for the duration of the block.
+        Files left behind by the job are removed on exit unless it was handed off.
+
+        Raises:
+            JobDeferred: if shutdown already started; the job is saved for the next process
+        """
+        self._queued.pop(job.id, None)
+        if not self.accepting:
+            self._defer(job)
+            raise JobDeferred("Bot is restarting, your download will resume shortly")
+
+        self._active[job.id] = (job, asyncio.current_task())
+        token = current_job.set(job)
+        try:
+            yield job
+        finally:
+            current_job.reset(token)
+            self._active.pop(job.id, None)
+            if job.id not in self._handed_off:
+                self.cleanup(job)
+
+    def active_jobs(self) -> List[Job]:
+        return [job for job, _ in self._active.values()]
+
+    def unfinished_jobs(self) -> List[Job]:
+        """Running jobs that were not delivered yet (a "done" job only has cleanup left)."""
+        return [job for job in self.active_jobs() if job.stage != "done"]
+
+    async def wait_idle(self, timeout: float = SHUTDOWN_TIMEOUT) -> List[Job]:
+        """
+        Stop accepting new jobs and wait up to `timeout` seconds for running ones.
+
+        Returns:
+            Jobs that are still running and undelivered after the deadline
+        """
+        self.accepting = False
+        tasks = {task for _, task in self._active.values()}
+        if tasks:
+            logger.info(f"Waiting up to {timeout}s for {len(tasks)} running job(s)")
+            await asyncio.wait(tasks, timeout=timeout)
+        return self.unfinished_jobs()
+
+    async def hand_off(self) -> List[Job]:
+        """
+        Abort and cancel the jobs still running, then save them to the journal
+        together with queued and deferred ones. Completed downloads are kept
+        on disk so the next process only has to upload them.
+
+        The journal is written only after the cancelled tasks have finished,
+        so jobs they released (queued batch items) are included; anything
+        deferred later is appended to it.
+
+        Returns:
+            Jobs written to the journal
+        """
+        unfinished = self.unfinished_jobs()
+        for job in unfinished:
+            if job.stage in HANDOFF_STAGES and job.file_path and os.path.exists(job.file_path):
+                self._handed_off.add(job.id)
+            else:
+                job.aborted = True
+                self._interrupted.append(job)
+
+        tasks = [task for _, task in self._active.values()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        pending = {job.id: job for job in unfinished + list(self._queued.values()) + self._deferred}
+        self._queued.clear()
+        self._deferred.clear()
+        self._journaled = [self._resumable(job) for job in pending.values()]
+        self.save_journal(self._journaled)
+        return self._journaled
+
+    def _resumable(self, job: Job) -> Job:
+        """Copy of `job` as it should be saved: without a file unless it was handed off."""
+        if job.id in self._handed_off:
+            return job
+        return Job.from_dict({**job.to_dict(), "file_path": None, "stage": "queued"})
+
+    def cleanup(self, job: Job) -> None:
+        """Delete the output and partial files of a job."""
+        paths = set(job.files)
+        if job.file_path:
+            paths.add(job.file_path)
+        remove_download_files(paths)
+
+    def finalize(self) -> None:
+        """
+        Clean up again after the cancelled jobs of `hand_off`. Call once worker
+        threads have exited: an aborted yt-dlp thread can still write a chunk
+        after its task was cancelled and cleaned up.
+        """
+        for job in self._interrupted:
+            self.cleanup(job)
+        self._interrupted.clear()
+
+    def save_journal(self, pending: Iterable[Job]) -> None:
+        pending = list(pending)
+        if not pending:
+            return
+        try:
+            tmp_path = self.journal_file + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump([job.to_dict() for job in pending], f)
+            os.replace(tmp_path, self.journal_file)
+            logger.info(f"Saved {len(pending)} unfinished job(s) to {self.journal_file}")
+        except Exception as e:
+            logger.error(f"Failed to save job journal: {e}")
+
+    def load_journal(self) -> List[Job]:
+        """
+        Read and remove the journal left by the previous process.
+
+        Returns:
+            Jobs to resume; expired entries are dropped and their files deleted
+        """
+        if not os.path.exists(self.journal_file):
+            return []
+        try:
+            with open(self.journal_file) as f:
+                entries = json.load(f)
+            os.remove(self.journal_file)
+        except Exception as e:
+            logger.error(f"Failed to load job journal: {e}")
+            return []
+
+        if not isinstance(entries, list):
+            logger.error(f"Ignoring job journal with unexpected content: {type(entries).__name__}")
+            return []
+
+        jobs = []
+        for entry in entries:
+            # One bad or outdated entry must not keep the bot from starting
+            try:
+                job = Job.from_dict(entry)
+                if time.time() - job.created_at > JOURNAL_MAX_AGE:
+                    logger.info(f"Dropping expired job {job.id} ({job.url})")
+                    self.cleanup(job)
+                    continue
+                if job.file_path and not os.path.exists(job.file_path):
+                    job.file_path = None
+                    job.stage = "queued"
+            except Exception as e:
+                logger.error(f"Skipping invalid journal entry {entry!r}: {e}")
+                continue
+            jobs.append(job)
+        logger.info(f"Loaded {len(jobs)} job(s) to resume")
+        return jobs
+
+    def sweep(self, keep: Iterable[str] = (), min_age: float = STALE_FILE_AGE,
+              directory: Optional[str] = None) -> None:
+        """
+        Delete files in the download directory (or `directory`) that no job owns,
+        e.g. leftovers of a crash. Files modified in the last `min_age` seconds
+        are left alone in case another process is still writing them.
+        """
+        keep = {os.path.abspath(path) for path in keep if path}
+        now = time.time()
+        for entry in os.scandir(directory or self.download_dir):
+            if not entry.is_file() or os.path.abspath(entry.path) in keep:
+                continue
+            try:
+                if now - entry.stat().st_mtime >= min_age:
+                    os.remove(entry.path)
+                    logger.info(f"Deleted stale file: {entry.path}")
+            except OSError as e:
+                logger.warning(f"Could not delete {entry.path}: {e}")
@@ -10,6 +10,12 @@ import yt_dlp
 from pathlib import Path
 import instagram_downloader
 import social_downloader
+import batch_downloader
+import jobs
+import format_selector
+import staging
+from contextlib import asynccontextmanager
+from typing import Optional
 from dotenv import load_dotenv
 from user_tracker import UserTracker
 
@@ -26,6 +32,9 @@ load_dotenv()
 DOWNLOAD_DIR = "downloads"
 Path(DOWNLOAD_DIR).mkdir(exist_ok=True)
 
+# Quality used for YouTube items in batch downloads (no per-item selection)
+BATCH_QUALITY = os.getenv("BATCH_QUALITY", "720")
+
 # Bot token (from environment)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
@@ -36,11 +45,36 @@ dp = Dispatcher()
 # Initialize user tracker
 user_tracker = UserTracker()
 
+# Tracks running downloads so shutdown can drain them and hand off the rest
+job_registry = jobs.JobRegistry(download_dir=DOWNLOAD_DIR)
+
+# The event loop only keeps weak references to tasks; resumed jobs live here until they finish
+resume_tasks = set()
+
 # Define states for FSM
 class DownloadStates(StatesGroup):
     waiting_for_url = State()
     waiting_for_quality = State()
 
+# (domains, platform, display name, emoji)
+PLATFORMS = [
+    (("youtube.com", "youtu.be"), "youtube", "YouTube", "📺"),
+    (("instagram.com",), "instagram", "Instagram", "📱"),
+    (("tiktok.com",), "tiktok", "TikTok", "🎵"),
+    (("twitter.com", "x.com"), "twitter", "Twitter/X", "🐦"),
+    (("facebook.com", "fb.watch"), "facebook", "Facebook", "👥"),
+    (("vimeo.com",), "vimeo", "Vimeo", "🎬"),
+    (("pinterest.com",), "pinterest", "Pinterest", "📌"),
+    (("reddit.com", "redd.it"), "reddit", "Reddit", "🤖"),
+]
+
+def detect_platform(url: str):
+    """Return (platform, display name, emoji) for a link, or None if unsupported"""
+    for domains, platform, platform_name, platform_emoji in PLATFORMS:
+        if any(domain in url for domain in domains):
+            return platform, platform_name, platform_emoji
+    return None
+
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext) -> None:
     """Handle /start command - track user and update bot description"""
@@ -72,82 +106,30 @@ HD & MP3 supported. Just send the link!
 @dp.message(F.text.contains("http"))
 async def handle_link(message: Message, state: FSMContext) -> None:
     """Handle video link from multiple platforms"""
-    url = message.text.strip()
+    urls = batch_downloader.extract_urls(message.text)
+    
+    # Several links or a playlist go through the batch pipeline
+    if len(urls) > 1 or (urls and batch_downloader.is_playlist_url(urls[0])):
+        await handle_batch(message, urls)
+        return
+    
+    url = urls[0] if urls else message.text.strip()
     
     # Detect platform
-    platform = None
-    platform_name = ""
-    platform_emoji = "📱"
-    
-    if "youtube.com" in url or "youtu.be" in url:
-        platform = "youtube"
-        platform_name = "YouTube"
-        platform_emoji = "📺"
-    elif "instagram.com" in url:
-        platform = "instagram"
-        platform_name = "Instagram"
-        platform_emoji = "📱"
-    elif "tiktok.com" in url:
-        platform = "tiktok"
-        platform_name = "TikTok"
-        platform_emoji = "🎵"
-    elif "twitter.com" in url or "x.com" in url:
-        platform = "twitter"
-        platform_name = "Twitter/X"
-        platform_emoji = "🐦"
-    elif "facebook.com" in url or "fb.watch" in url:
-        platform = "facebook"
-        platform_name = "Facebook"
-        platform_emoji = "👥"
-    elif "vimeo.com" in url:
-        platform = "vimeo"
-        platform_name = "Vimeo"
-        platform_emoji = "🎬"
-    elif "pinterest.com" in url:
-        platform = "pinterest"
-        platform_name = "Pinterest"
-        platform_emoji = "📌"
-    elif "reddit.com" in url or "redd.it" in url:
-        platform = "reddit"
-        platform_name = "Reddit"
-        platform_emoji = "🤖"
-    else:
+    detected = detect_platform(url)
+    if detected is None:
         await message.answer("❌ Please send a valid link from supported platforms!\n\n"
                            "Supported: YouTube, Instagram, TikTok, Twitter/X, Facebook, Vimeo, Pinterest, Reddit")
         return
+    platform, platform_name, platform_emoji = detected
     
     # For social media platforms (not YouTube), download directly without quality selection
     if platform != "youtube":
         downloading_msg = await message.answer(f"{platform_emoji} Downloading from {platform_name}... Please wait!")
         
-        try:
-            if platform == "instagram":
-                file_path = await instagram_downloader.download_instagram_video(url, message.from_user.id)
-                title = await instagram_downloader.get_instagram_title(url)
-            else:
-                file_path = await social_downloader.download_social_video(url, message.from_user.id, platform)
-                title = await social_downloader.get_social_title(url)
-            
-            await downloading_msg.edit_text("📤 Uploading to Telegram...")
-            
-            await bot.send_video(
-                chat_id=message.chat.id,
-                video=types.FSInputFile(file_path),
-                caption=f"🎬 <b>{title}</b>\n\n📱 From: {platform_name}",
-                parse_mode="HTML"
-            )
-            
-            await downloading_msg.delete()
-            
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Deleted file: {file_path}")
-            
+        job = jobs.Job(chat_id=message.chat.id, user_id=message.from_user.id, url=url, platform=platform)
+        if await process_job(job, downloading_msg):
             await message.answer("✅ Done! Send another link to download more videos.")
-            
-        except Exception as e:
-            logger.error(f"Error: {str(e)}")
-            await downloading_msg.edit_text(f"❌ Error: {str(e)}\n\nTry another video.")
         
         return
     
@@ -187,75 +169,228 @@ async def handle_quality_selection(callback_query: CallbackQuery, state: FSMCont
     platform_emoji = "📺" if platform == "youtube" else "📱"
     downloading_msg = await callback_query.message.edit_text(f"{platform_emoji} Downloading... Please wait!")
     
+    job = jobs.Job(
+        chat_id=callback_query.message.chat.id,
+        user_id=callback_query.from_user.id,
+        url=video_url,
+        platform=platform,
+        quality=quality,
+    )
+    if await process_job(job, downloading_msg):
+        platform_name = "YouTube" if platform == "youtube" else "Instagram"
+        await callback_query.message.answer(f"✅ Done! Send another {platform_name}, YouTube, or Instagram link to download more videos.")
+    await state.set_state(DownloadStates.waiting_for_url)
+
+async def download_job_file(job: jobs.Job) -> str:
+    """Download the file for a job based on its platform and quality, reusing its fetched metadata"""
+    info, job.info = job.info, None
+    if job.platform == "youtube":
+        if job.quality == "mp3":
+            download = await download_mp3(job.url, job.user_id, info)
+        else:
+            download = await download_video(job.url, job.quality or BATCH_QUALITY, job.user_id, info)
+    elif job.platform == "instagram":
+        if job.quality == "mp3":
+            download = await instagram_downloader.download_instagram_audio(job.url, job.user_id, info)
+        else:
+            download = await instagram_downloader.download_instagram_video(job.url, job.user_id, info)
+    else:
+        download = await social_downloader.download_social_video(job.url, job.user_id, job.platform, info)
+    
+    # The selector may settle below the requested resolution; the caption shows what was sent
+    if download.choice is not None:
+        job.height = download.choice.height
+    return download.path
+
+async def fetch_job_title(job: jobs.Job) -> str:
+    """Get the title for a job's link, keeping the metadata for its download"""
+    if job.info is None:
+        job.info = await asyncio.to_thread(staging.extract_info, job.url)
+    if job.platform == "youtube":
+        return await get_video_title(job.url, job.info)
+    if job.platform == "instagram":
+        return await instagram_downloader.get_instagram_title(job.url, job.info)
+    return await social_downloader.get_social_title(job.url, job.info)
+
+async def send_job_file(job: jobs.Job, note: str = "") -> None:
+    """Send a job's downloaded file to its chat"""
+    if job.quality == "mp3":
+        await bot.send_audio(
+            chat_id=job.chat_id,
+            audio=types.FSInputFile(job.file_path),
+            caption=f"🎵 <b>{job.title}</b>{note}",
+            parse_mode="HTML"
+        )
+    elif job.quality:
+        quality = f"{job.height}p" if job.height else job.quality
+        await bot.send_video(
+            chat_id=job.chat_id,
+            video=types.FSInputFile(job.file_path),
+            caption=f"🎬 <b>{job.title}</b>\n\n📊 Quality: {quality} Video{note}",
+            parse_mode="HTML"
+        )
+    else:
+        await bot.send_video(
+            chat_id=job.chat_id,
+            video=types.FSInputFile(job.file_path),
+            caption=f"🎬 <b>{job.title}</b>\n\n📱 From: {detect_platform(job.url)[1]}{note}",
+            parse_mode="HTML"
+        )
+
+async def process_job(job: jobs.Job, status_msg: Message) -> bool:
+    """
+    Download, upload and clean up a single job; shared by the handlers and resume.
+    Returns True if the file was delivered.
+    """
+    job.status_message_id = status_msg.message_id
     try:
-        # Download video based on platform and quality selection
-        if platform == "youtube":
-            if quality == "mp3":
-                file_path = await download_mp3(video_url, callback_query.from_user.id)
-                format_type = "MP3"
-            else:
-                file_path = await download_video(video_url, quality, callback_query.from_user.id)
-                format_type = f"{quality} Video"
-            title = await get_video_title(video_url)
-        else:  # Instagram
-            if quality == "mp3":
-                file_path = await instagram_downloader.download_instagram_audio(video_url, callback_query.from_user.id)
-                format_type = "MP3"
-            else:
-                file_path = await instagram_downloader.download_instagram_video(video_url, callback_query.from_user.id)
-                format_type = "Video"
-            title = await instagram_downloader.get_instagram_title(video_url)
-        
-        # Update downloading message
-        await downloading_msg.edit_text("📤 Uploading to Telegram...")
+        async with job_registry.track(job):
+            try:
+                # The title comes first so the download reuses its metadata;
+                # a handed-off job already has both and only needs the upload
+                if job.title is None:
+                    job.title = await fetch_job_title(job)
+                if job.file_path is None:
+                    job.stage = "downloading"
+                    job.file_path = await download_job_file(job)
+                    job.stage = "downloaded"
+                
+                await status_msg.edit_text("📤 Uploading to Telegram...")
+                job.stage = "uploading"
+                await send_job_file(job)
+                job.stage = "done"
+                
+                await status_msg.delete()
+                return True
+            
+            except Exception as e:
+                logger.error(f"Error: {str(e)}")
+                await status_msg.edit_text(f"❌ Error: {str(e)}\n\nTry another video.")
+                return False
+    except jobs.JobDeferred as e:
+        await status_msg.edit_text(f"⏸ {e}")
+        return False
+
+async def resume_job(job: jobs.Job) -> None:
+    """Continue a job handed off by the previous process"""
+    text = "♻️ Bot restarted, resuming your download..."
+    try:
+        try:
+            status_msg = await bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.status_message_id)
+        except Exception:
+            status_msg = await bot.send_message(job.chat_id, text)
         
-        # Send file to user
-        if quality == "mp3":
-            await bot.send_audio(
-                chat_id=callback_query.message.chat.id,
-                audio=types.FSInputFile(file_path),
-                caption=f"🎵 <b>{title}</b>",
-                parse_mode="HTML"
-            )
+        if await process_job(job, status_msg):
+            await bot.send_message(job.chat_id, "✅ Done! Send another link to download more videos.")
+    except Exception as e:
+        logger.error(f"Failed to resume job {job.id}: {str(e)}")
+        job_registry.unqueue(job)
+        job_registry.cleanup(job)
+
+async def handle_batch(message: Message, urls: list) -> None:
+    """Download several links (or an expanded playlist) with one aggregated status message"""
+    status_msg = await message.answer("📦 Preparing batch download...")
+    
+    expanded = []
+    for url in urls:
+        if batch_downloader.is_playlist_url(url):
+            try:
+                expanded.extend(await batch_downloader.expand_playlist(url))
+            except Exception as e:
+                logger.error(f"Failed to expand playlist {url}: {str(e)}")
+                expanded.append(url)
+        else:
+            expanded.append(url)
+    
+    # The same video twice would download to the same file
+    expanded = list(dict.fromkeys(expanded))
+    
+    if not expanded:
+        await status_msg.edit_text("❌ No videos found in this playlist.")
+        return
+    
+    skipped = max(0, len(expanded) - batch_downloader.MAX_BATCH_ITEMS)
+    items = []
+    for index, url in enumerate(expanded[:batch_downloader.MAX_BATCH_ITEMS]):
+        detected = detect_platform(url)
+        item = batch_downloader.BatchItem(index=index, url=url, platform=detected[0] if detected else None)
+        if detected is None:
+            item.error = "Unsupported link"
         else:
-            await bot.send_video(
-                chat_id=callback_query.message.chat.id,
-                video=types.FSInputFile(file_path),
-                caption=f"🎬 <b>{title}</b>\n\n📊 Quality: {format_type}",
-                parse_mode="HTML"
+            # Each item is its own job, queued now so shutdown hands off items
+            # that are still waiting for their turn as well as running ones
+            item.job = jobs.Job(
+                chat_id=message.chat.id,
+                user_id=message.from_user.id,
+                url=url,
+                platform=item.platform,
+                quality=BATCH_QUALITY if item.platform == "youtube" else None,
             )
-        
-        # Delete downloading message
-        await downloading_msg.delete()
-        
-        # Delete the downloaded file after sending
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            logger.info(f"Deleted file: {file_path}")
-        
-        platform_name = "YouTube" if platform == "youtube" else "Instagram"
-        await callback_query.message.answer(f"✅ Done! Send another {platform_name}, YouTube, or Instagram link to download more videos.")
-        await state.set_state(DownloadStates.waiting_for_url)
+            job_registry.queue(item.job)
+        items.append(item)
     
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        await downloading_msg.edit_text(f"❌ Error: {str(e)}\n\nTry another video.")
-        await state.set_state(DownloadStates.waiting_for_url)
+    last_status = {"text": ""}
+    
+    @asynccontextmanager
+    async def track_item(item: batch_downloader.BatchItem):
+        if item.job is None:
+            yield item
+            return
+        async with job_registry.track(item.job):
+            yield item
+    
+    async def fetch_metadata(item: batch_downloader.BatchItem) -> None:
+        item.title = item.job.title = await fetch_job_title(item.job)
+    
+    async def download(item: batch_downloader.BatchItem) -> None:
+        item.job.stage = "downloading"
+        item.file_path = item.job.file_path = await download_job_file(item.job)
+        item.job.stage = "downloaded"
+    
+    async def deliver(item: batch_downloader.BatchItem) -> None:
+        item.job.stage = "uploading"
+        await send_job_file(item.job, note=f" ({item.index + 1}/{len(items)})")
+        item.job.stage = "done"
+    
+    async def update_status(batch_items) -> None:
+        text = batch_downloader.render_status(batch_items)
+        if skipped:
+            text += f"\n\n⚠️ {skipped} more link(s) skipped (limit {batch_downloader.MAX_BATCH_ITEMS})"
+        if text != last_status["text"]:
+            last_status["text"] = text
+            await status_msg.edit_text(text)
+    
+    # yt-dlp runs merges and audio extraction as part of the download call,
+    # so post-processing overlaps with other items' metadata and uploads
+    pipeline = batch_downloader.BatchPipeline(
+        stages=[
+            batch_downloader.Stage("fetching info", fetch_metadata, concurrency=4),
+            batch_downloader.Stage("downloading", download, concurrency=3),
+        ],
+        deliver=deliver,
+        on_progress=update_status,
+        item_context=track_item,
+        interrupted_errors=(jobs.JobDeferred,),
+    )
+    results = await pipeline.run(items)
+    
+    done = sum(1 for item in results if item.status == "done")
+    interrupted = sum(1 for item in results if item.status == "interrupted")
+    if interrupted:
+        await message.answer(f"⏸ Batch paused: {done}/{len(results)} delivered, "
+                             f"{interrupted} will continue after the bot restarts.")
+    else:
+        await message.answer(f"✅ Batch finished: {done}/{len(results)} delivered. Send more links any time!")
 
-async def download_video(url: str, quality: str, user_id: int) -> str:
+async def download_video(url: str, quality: str, user_id: int, info: Optional[dict] = None) -> staging.StagedDownload:
     """Download video with specified quality"""
     
-    quality_map = {
-        "480": "bestvideo[height<=480][ext=mp4]+bestaudio[ext=m4a]/best[height<=480][ext=mp4]",
-        "720": "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720][ext=mp4]",
-        "1080": "bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080][ext=mp4]",
-    }
-    
-    format_str = quality_map.get(quality, "best[ext=mp4]/best")
+    # Ranks formats by processing cost: progressive H.264/AAC MP4 first, merge only when needed
+    format_opts = format_selector.format_options(max_height=int(quality) if quality.isdigit() else None)
     
     ydl_opts = {
-        'format': format_str,
-        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{user_id}_%(title)s.%(ext)s'),
+        **format_opts,
+        'outtmpl': f'{user_id}_%(title)s [%(id)s].%(ext)s',
         'quiet': False,
         'no_warnings': True,
         'socket_timeout': 30,
@@ -266,14 +401,9 @@ async def download_video(url: str, quality: str, user_id: int) -> str:
         'fragment_retries': 10,
     }
 
-    def _do_download() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            return ydl.prepare_filename(info)
+    return await asyncio.to_thread(staging.download_staged, ydl_opts, url, info)
 
-    return await asyncio.to_thread(_do_download)
-
-async def download_mp3(url: str, user_id: int) -> str:
+async def download_mp3(url: str, user_id: int, info: Optional[dict] = None) -> staging.StagedDownload:
     """Download video as MP3"""
     
     ydl_opts = {
@@ -283,7 +413,7 @@ async def download_mp3(url: str, user_id: int) -> str:
             'preferredcodec': 'mp3',
             'preferredquality': '192',
         }],
-        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{user_id}_%(title)s.%(ext)s'),
+        'outtmpl': f'{user_id}_%(title)s [%(id)s].%(ext)s',
         'quiet': False,
         'no_warnings': True,
         'socket_timeout': 30,
@@ -292,16 +422,14 @@ async def download_mp3(url: str, user_id: int) -> str:
         'noplaylist': True,
     }
 
-    def _do_download_mp3() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            file_path_local = ydl.prepare_filename(info)
-            return os.path.splitext(file_path_local)[0] + '.mp3'
+    def _do_download_mp3() -> staging.StagedDownload:
+        download = staging.download_staged(ydl_opts, url, info)
+        return download._replace(path=os.path.splitext(download.path)[0] + '.mp3')
 
     return await asyncio.to_thread(_do_download_mp3)
 
-async def get_video_title(url: str) -> str:
-    """Get video title"""
+async def get_video_title(url: str, info: Optional[dict] = None) -> str:
+    """Get video title (from `info` if already fetched)"""
     
     ydl_opts = {
         'quiet': True,
@@ -312,9 +440,11 @@ async def get_video_title(url: str) -> str:
     }
 
     def _do_get_title() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return info.get('title', 'Unknown Title')
+        data = info
+        if data is None:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                data = ydl.extract_info(url, download=False)
+        return data.get('title') or 'Unknown Title'
 
     return await asyncio.to_thread(_do_get_title)
 
@@ -346,15 +476,65 @@ async def cmd_stats(message: Message) -> None:
         f"📆 First User: {stats['first_user_date']}"
     )
 
+async def shutdown() -> None:
+    """Drain running jobs, hand unfinished ones to the next process and clean up"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + jobs.SHUTDOWN_TIMEOUT
+    
+    unfinished = await job_registry.wait_idle(jobs.SHUTDOWN_TIMEOUT)
+    for job in unfinished:
+        if job.status_message_id:
+            try:
+                await bot.edit_message_text("⏸ Bot is restarting, your download will resume shortly.",
+                                            chat_id=job.chat_id, message_id=job.status_message_id)
+            except Exception as e:
+                logger.debug(f"Could not notify chat {job.chat_id}: {e}")
+    await job_registry.hand_off()
+    
+    # Resumes that have not reached the registry yet are queued there and were just saved again
+    for task in resume_tasks:
+        task.cancel()
+    await asyncio.gather(*resume_tasks, return_exceptions=True)
+    
+    # Aborted yt-dlp threads may still be writing; wait for them before the final cleanup,
+    # but not past the deadline. asyncio.wait (unlike wait_for) does not cancel the
+    # shutdown task, whose cancellation would block on joining the threads anyway.
+    remaining = max(deadline - loop.time(), jobs.THREAD_EXIT_TIMEOUT)
+    executor_shutdown = asyncio.create_task(loop.shutdown_default_executor())
+    done, _ = await asyncio.wait({executor_shutdown}, timeout=remaining)
+    job_registry.finalize()
+    await bot.session.close()
+    
+    if not done:
+        # asyncio.run and the interpreter would join the stuck threads again, without a limit
+        logger.error(f"Worker threads still running after {remaining:.0f}s, exiting without them")
+        logging.shutdown()
+        os._exit(1)
+
 async def main() -> None:
     """Start the bot"""
     print("🤖 Bot started! Press Ctrl+C to stop.")
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is not set. Create a .env file with BOT_TOKEN=your_telegram_bot_token")
+    
+    # Pick up jobs the previous process could not finish and remove its leftovers
+    pending = job_registry.load_journal()
+    handed_off = [job.file_path for job in pending]
+    job_registry.sweep(keep=handed_off)
+    if staging.staging_area.enabled:
+        job_registry.sweep(keep=handed_off, directory=staging.staging_area.ram_dir)
+    for job in pending:
+        job_registry.queue(job)
+        task = asyncio.create_task(resume_job(job))
+        resume_tasks.add(task)
+        task.add_done_callback(resume_tasks.discard)
+    
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        # The session stays open after polling stops so running uploads can finish
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(),
+                               close_bot_session=False)
     finally:
-        await bot.session.close()
+        await shutdown()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -1,18 +1,23 @@
-import os
 import yt_dlp
 import asyncio
 import logging
+from typing import Optional
+import format_selector
+import staging
 
 logger = logging.getLogger(__name__)
 
 DOWNLOAD_DIR = "downloads"
 
-async def download_social_video(url: str, user_id: int, platform: str = "social") -> str:
+async def download_social_video(url: str, user_id: int, platform: str = "social",
+                                info: Optional[dict] = None) -> staging.StagedDownload:
     """Download video from social media platforms (TikTok, Twitter, Facebook, Vimeo, Pinterest, Reddit)"""
     
+    format_opts = format_selector.format_options()
+    
     ydl_opts = {
-        'format': 'best',
-        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{user_id}_%(title)s.%(ext)s'),
+        **format_opts,
+        'outtmpl': f'{user_id}_%(title)s [%(id)s].%(ext)s',
         'quiet': False,
         'no_warnings': True,
         'socket_timeout': 30,
@@ -27,15 +32,10 @@ async def download_social_video(url: str, user_id: int, platform: str = "social"
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
     
-    def _do_download() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            return ydl.prepare_filename(info)
-
-    return await asyncio.to_thread(_do_download)
+    return await asyncio.to_thread(staging.download_staged, ydl_opts, url, info)
 
-async def get_social_title(url: str) -> str:
-    """Get video title from social media platforms"""
+async def get_social_title(url: str, info: Optional[dict] = None) -> str:
+    """Get video title from social media platforms (from `info` if already fetched)"""
     
     ydl_opts = {
         'quiet': True,
@@ -45,9 +45,11 @@ async def get_social_title(url: str) -> str:
     }
 
     def _do_get_title() -> str:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            t = info.get('title', 'Video')
-            return t if len(t) <= 100 else t[:97] + "..."
+        data = info
+        if data is None:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                data = ydl.extract_info(url, download=False)
+        t = data.get('title') or 'Video'
+        return t if len(t) <= 100 else t[:97] + "..."
 
     return await asyncio.to_thread(_do_get_title)
@@ -0,0 +1,220 @@
+"""
+Tiered staging for downloads.
+Clips expected to be small are written to a memory-backed directory (tmpfs)
+instead of DOWNLOAD_DIR, so the download, upload and delete never touch disk.
+Everything else, and anything that would exceed the memory budget, goes to disk.
+"""
+
+import os
+import copy
+import glob
+import errno
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple, Optional
+import yt_dlp
+import jobs
+from format_selector import FormatChoice, FormatSelector, estimate_size
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_DIR = "downloads"
+RAM_STAGING_DIR = os.getenv("RAM_STAGING_DIR", "/dev/shm/video_downloader")  # Empty to disable
+RAM_STAGING_BUDGET = int(os.getenv("RAM_STAGING_BUDGET_MB", "256")) * 1024 * 1024
+RAM_STAGING_MAX_FILE = int(os.getenv("RAM_STAGING_MAX_FILE_MB", "20")) * 1024 * 1024
+SCRATCH_FACTOR = 2  # Merges and audio extraction keep inputs and output side by side
+
+METADATA_OPTIONS = {
+    'quiet': True,
+    'no_warnings': True,
+    'socket_timeout': 30,
+    'nocheckcertificate': True,
+    'noplaylist': True,
+}
+
+
+class StagingArea:
+    """
+    Chooses where a download is written and accounts for the memory tier.
+
+    Usage is measured from the files actually in the RAM directory plus the
+    reservations of downloads still running, so deleting a file with plain
+    os.remove is enough to give its space back.
+    """
+
+    def __init__(self, disk_dir: str = DOWNLOAD_DIR, ram_dir: Optional[str] = RAM_STAGING_DIR,
+                 budget: int = RAM_STAGING_BUDGET, max_file: int = RAM_STAGING_MAX_FILE):
+        """Initialize the tiers; the RAM tier is disabled if `ram_dir` is unusable."""
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir or None
+        self.budget = budget
+        self.max_file = max_file
+        self._lock = threading.Lock()
+        self._reserved = 0
+
+        if self.ram_dir:
+            try:
+                os.makedirs(self.ram_dir, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"RAM staging disabled, cannot use {self.ram_dir}: {e}")
+                self.ram_dir = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ram_dir is not None and self.budget > 0
+
+    def ram_usage(self) -> int:
+        """Bytes currently held in the RAM tier, including running reservations."""
+        used = self._reserved
+        for entry in os.scandir(self.ram_dir):
+            try:
+                if entry.is_file():
+                    used += entry.stat().st_size
+            except OSError:
+                continue
+        return used
+
+    @contextmanager
+    def stage(self, estimate: Optional[int], scratch: bool = False) -> Iterator[str]:
+        """
+        Pick the directory for one download and hold its reservation until exit.
+
+        Args:
+            estimate: Expected size of the final file in bytes (None if unknown)
+            scratch: Whether ffmpeg needs room for intermediate files
+
+        Yields:
+            Directory to download into
+        """
+        needed = (estimate or 0) * (SCRATCH_FACTOR if scratch else 1)
+        reserved = 0
+        if self.enabled and estimate and estimate <= self.max_file:
+            with self._lock:
+                fits_budget = self.ram_usage() + needed <= self.budget
+                if fits_budget and shutil.disk_usage(self.ram_dir).free > needed:
+                    self._reserved += needed
+                    reserved = needed
+            if not reserved:
+                logger.info(f"RAM staging budget exhausted, spilling {estimate} bytes to disk")
+
+        try:
+            yield self.ram_dir if reserved else self.disk_dir
+        finally:
+            if reserved:
+                with self._lock:
+                    self._reserved -= reserved
+
+
+staging_area = StagingArea()
+
+
+class StagedDownload(NamedTuple):
+    """Result of download_staged."""
+
+    path: str  # As written by yt-dlp, before any post-processor changed the extension
+    choice: Optional[FormatChoice]  # Set when the 'format' option was a FormatSelector
+
+
+def expected_size(info: dict, selector: Optional[FormatSelector] = None) -> Optional[int]:
+    """Size of the format yt-dlp selected, from the selector's choice or the info dict."""
+    if selector is not None and selector.choice and selector.choice.size:
+        return selector.choice.size
+    requested = info.get("requested_formats")
+    if requested:
+        sizes = [estimate_size(fmt) for fmt in requested]
+        return sum(sizes) if all(sizes) else None
+    return estimate_size(info)
+
+
+def _out_of_space(error: BaseException) -> bool:
+    """Whether an error (or one it wraps, as yt-dlp's DownloadError does) is ENOSPC."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, OSError) and error.errno == errno.ENOSPC:
+            return True
+        if "No space left on device" in str(error):
+            return True
+        exc_info = getattr(error, "exc_info", None)
+        error = exc_info[1] if exc_info else error.__cause__ or error.__context__
+    return False
+
+
+def _download_into(ydl_opts: dict, info: dict, directory: str) -> str:
+    with yt_dlp.YoutubeDL({**ydl_opts, 'paths': {'home': directory}}) as ydl:
+        info = ydl.process_ie_result(info, download=True)
+        return ydl.prepare_filename(info)
+
+
+def _remove_partial_ram_files(ydl_opts: dict, info: dict) -> None:
+    """Delete what a failed download left in the RAM tier."""
+    with yt_dlp.YoutubeDL({**ydl_opts, 'paths': {'home': staging_area.ram_dir}}) as ydl:
+        output = ydl.prepare_filename(info)
+    # The name includes the video id, so its siblings (e.g. a partial .mp3) are ours
+    paths = {output, *glob.glob(glob.escape(os.path.splitext(output)[0]) + ".*")}
+    job = jobs.current_job.get()
+    if job is not None:
+        paths.update(job.files)
+    ram_dir = os.path.join(os.path.abspath(staging_area.ram_dir), "")
+    jobs.remove_download_files(path for path in paths if os.path.abspath(path).startswith(ram_dir))
+
+
+def extract_info(url: str) -> dict:
+    """
+    Fetch the metadata of a link without selecting a format, so it can be
+    shown first and passed to download_staged later instead of extracting twice.
+    Blocking; run it with asyncio.to_thread.
+    """
+    with yt_dlp.YoutubeDL(METADATA_OPTIONS) as ydl:
+        return ydl.extract_info(url, download=False, process=False)
+
+
+def download_staged(ydl_opts: dict, url: str, info: Optional[dict] = None) -> StagedDownload:
+    """
+    Download `url` into the tier that fits its expected size.
+    Blocking; run it with asyncio.to_thread like the other yt-dlp calls.
+
+    Callers pass only their own options: the output directory is chosen here
+    and the job progress hook is added. A relative 'outtmpl' is required.
+
+    Metadata is extracted once, or taken from `info` (see extract_info); the
+    download itself reuses that result with the output directory chosen from
+    the selected format's size. If the RAM tier runs out of space anyway (low
+    estimate, small tmpfs), the partial files are removed and the download is
+    retried once on disk.
+
+    Returns:
+        The path yt-dlp wrote and the format chosen by a FormatSelector
+    """
+    ydl_opts = {'progress_hooks': [jobs.progress_hook], **ydl_opts}
+    selector = ydl_opts.get('format')
+    if not isinstance(selector, FormatSelector):
+        selector = None
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        if info is None:
+            info = ydl.extract_info(url, download=False)
+        else:
+            # Only selects the format; the caller's dict is left as it was
+            info = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    if selector is not None and selector.choice:
+        logger.info(f"Format for {url}: {selector.choice.describe()}")
+
+    estimate = expected_size(info, selector)
+    choice = selector.choice if selector is not None else None
+    scratch = bool(ydl_opts.get('postprocessors') or info.get('requested_formats'))
+    with staging_area.stage(estimate, scratch=scratch) as directory:
+        if directory == staging_area.disk_dir:
+            return StagedDownload(_download_into(ydl_opts, info, directory), choice)
+        try:
+            # process_ie_result annotates the info dict; keep the original for a retry
+            return StagedDownload(_download_into(ydl_opts, copy.deepcopy(info), directory), choice)
+        except Exception as e:
+            if not _out_of_space(e):
+                raise
+            logger.warning(f"RAM staging ran out of space for {url}, retrying on disk")
+            _remove_partial_ram_files(ydl_opts, info)
+
+    return StagedDownload(_download_into(ydl_opts, info, staging_area.disk_dir), choice)